@@ -0,0 +1,16 @@
+-- Add partial index for the PotWithdrawn analytics branch (PostgreSQL)
+-- Created: 2026-08-30
+
+-- The dashboard reads storage_incentives_events with a six-value
+-- event_type IN (...) list, which the existing composite index on
+-- (event_type, block_number, log_index) already serves; per-literal partial
+-- indexes would not be usable for an IN list. The one predicate without any
+-- index support is the PotWithdrawn branch on the events table, which also
+-- carries a block_number > N delta condition on incremental refreshes.
+-- Scope a single partial index to exactly those rows.
+CREATE INDEX IF NOT EXISTS idx_events_pot_withdrawn_block_log
+    ON events(block_number, log_index)
+    WHERE event_type = 'PotWithdrawn' AND pot_total_amount IS NOT NULL;
+
+-- Refresh planner statistics so the new index is picked up immediately
+ANALYZE events;
@@ -0,0 +1,376 @@
+"""Shared data layer for the plot scripts.
+
+Connection handling, query definitions, result caching and the metric
+derivations live here so the plot scripts themselves are only figure
+construction. Importing this module never touches matplotlib, so scripts can
+pick their backend before pulling in pyplot.
+
+Requires psycopg2-binary>=2.9: the prebuilt libpq handles the binary COPY
+protocol used by the fast fetch path below.
+"""
+
+import functools
+import glob
+import hashlib
+import io
+import os
+
+import psycopg2
+import psycopg2.extensions
+import pandas as pd
+import numpy as np
+from dotenv import load_dotenv
+
+# Optional: Rust-based Postgres→Arrow reader. The binary COPY path below
+# covers the same ground when it isn't installed.
+try:
+    import connectorx as _connectorx
+except ImportError:
+    _connectorx = None
+
+# Postgres NUMERIC decodes to decimal.Decimal by default, which pandas stores
+# as object dtype — every downstream arithmetic or draw call then boxes per
+# element. We only ever plot these values, so float64 precision is plenty.
+DEC2FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, 'DEC2FLOAT',
+    lambda value, cur: float(value) if value is not None else None)
+psycopg2.extensions.register_type(DEC2FLOAT)
+
+load_dotenv()
+
+# Every query below filters on event_type and reads/orders by
+# (block_number, log_index). Without a matching composite index Postgres falls
+# back to sequential scans of the whole events table for each query, which is
+# minutes instead of milliseconds once the table has a few million rows. The
+# INCLUDE list makes the hot queries index-only scans. Created idempotently at
+# startup; casts stay in the SELECT list so the WHERE clauses remain sargable.
+SIE_COVERING_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS sie_type_block_log
+    ON storage_incentives_events (event_type, block_number, log_index)
+    INCLUDE (reveal_count, commit_count, chunk_count, price, freeze_time)
+"""
+
+# Numeric tags for the long-format metrics query below; smallint keeps the
+# column fixed-width for the binary COPY decoder
+(SERIES_WINNER, SERIES_REVEALS, SERIES_COMMITS, SERIES_CHUNKS,
+ SERIES_PRICE, SERIES_FROZEN, SERIES_POT) = range(1, 8)
+
+# ALL metric data in ONE round trip. Long format — one float8 value per row
+# plus a smallint series tag — gives every UNION branch the same fixed-width
+# schema, so a single scan of storage_incentives_events plus the pot rows from
+# events covers the whole dashboard and the result decodes on the binary COPY
+# fast path. WinnerSelected rows carry NaN: only their keys are used, for the
+# winner gate and the frozen-count bucketing, both computed client-side.
+# A session-local temp table would also collapse the scans, but a plain
+# single fetch needs no DDL and no session pinning.
+METRICS_SQL = f"""
+    SELECT CASE event_type
+               WHEN 'WinnerSelected' THEN {SERIES_WINNER}
+               WHEN 'CountReveals' THEN {SERIES_REVEALS}
+               WHEN 'CountCommits' THEN {SERIES_COMMITS}
+               WHEN 'ChunkCount' THEN {SERIES_CHUNKS}
+               WHEN 'PriceUpdate' THEN {SERIES_PRICE}
+               WHEN 'StakeFrozen' THEN {SERIES_FROZEN}
+           END::int2 AS series,
+           block_number, log_index,
+           COALESCE(CASE event_type
+               WHEN 'CountReveals' THEN reveal_count::float8
+               WHEN 'CountCommits' THEN commit_count::float8
+               WHEN 'ChunkCount' THEN chunk_count::float8
+               WHEN 'PriceUpdate' THEN price::float8
+               WHEN 'StakeFrozen' THEN freeze_time::float8
+           END, 'NaN'::float8) AS value
+    FROM storage_incentives_events
+    WHERE event_type IN ('CountReveals', 'CountCommits', 'ChunkCount',
+                         'WinnerSelected', 'PriceUpdate', 'StakeFrozen') {{delta}}
+    UNION ALL
+    SELECT {SERIES_POT}::int2, block_number, log_index,
+           pot_total_amount::float8
+    FROM events
+    WHERE event_type = 'PotWithdrawn' AND pot_total_amount IS NOT NULL {{delta}}
+    ORDER BY series, block_number, log_index
+"""
+
+METRICS_SORT_KEYS = ['series', 'block_number', 'log_index']
+
+METRICS_COLUMNS = {'series': 'i2', 'block_number': 'i8', 'log_index': 'i8', 'value': 'f8'}
+
+# (plot label, series tag) for the winner-gated round metrics
+ROUND_METRICS = [
+    ("Reveals", SERIES_REVEALS),
+    ("Commits", SERIES_COMMITS),
+    ("Chunks", SERIES_CHUNKS),
+]
+
+# Query results are memoized here as parquet (needs pyarrow or fastparquet).
+# Event history is append-only, so a (max block, row count) fingerprint of the
+# source tables says whether a memo is current, and a stale memo is still a
+# valid prefix that only needs the new blocks appended.
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+TABLE_FINGERPRINT_SQL = "SELECT max(block_number), count(*) FROM {table}"
+
+
+def conn_kwargs():
+    return dict(
+        dbname=os.getenv("DB_NAME", "beeport2"),
+        user=os.getenv("DB_USER", "sig32"),
+        password=os.getenv("DB_PASS", ""),
+        host=os.getenv("DB_HOST", "localhost"),
+        port=os.getenv("DB_PORT", "5432"),
+    )
+
+
+def conn_str():
+    kw = conn_kwargs()
+    auth = kw['user'] if not kw['password'] else f"{kw['user']}:{kw['password']}"
+    return f"postgresql://{auth}@{kw['host']}:{kw['port']}/{kw['dbname']}"
+
+
+@functools.lru_cache(maxsize=None)
+def get_conn():
+    """Process-wide connection for one-off statements (DDL, fingerprints).
+
+    Cached so repeated calls — and multiple scripts importing this module in
+    one process — share a single TCP/TLS handshake.
+    """
+    return psycopg2.connect(**conn_kwargs())
+
+
+def read_sql_copy(sql, conn, dtype=None):
+    """Fetch a query result via COPY ... TO STDOUT instead of pd.read_sql.
+
+    pd.read_sql over psycopg2 builds a Python tuple per row before the
+    DataFrame ever exists; streaming one CSV blob into pandas' C parser is
+    several times faster on large result sets.
+    """
+    buf = io.StringIO()
+    with conn.cursor() as cur:
+        cur.copy_expert(f"COPY ({sql}) TO STDOUT WITH CSV HEADER", buf)
+    buf.seek(0)
+    return pd.read_csv(buf, dtype=dtype)
+
+
+def read_sql_copy_binary(sql, conn, columns, dtype=None):
+    """COPY BINARY fast path for fixed-width bigint/float8 result sets.
+
+    Skips both the server's text encode and the client's text parse: for
+    non-null fixed-width columns every PGCOPY row has the same byte length,
+    so the entire body decodes as a single big-endian numpy structured array.
+    Falls back to the CSV path whenever the layout doesn't match (NULLs,
+    unexpected column count).
+
+    columns maps column name -> numpy type code ('i2', 'i8' or 'f8').
+    """
+    buf = io.BytesIO()
+    with conn.cursor() as cur:
+        cur.copy_expert(f"COPY ({sql}) TO STDOUT WITH BINARY", buf)
+    data = buf.getvalue()
+    # 11-byte signature, 4 flag bytes, 4-byte extension length (+ extension),
+    # then rows, then a 2-byte 0xFFFF trailer
+    ext_len = int.from_bytes(data[15:19], 'big')
+    body = data[19 + ext_len:-2]
+    row_dtype = np.dtype(
+        [('_nfields', '>i2')]
+        + [field for name, code in columns.items()
+           for field in ((f'_len_{name}', '>i4'), (name, f'>{code}'))])
+    if len(body) % row_dtype.itemsize:
+        return read_sql_copy(sql, conn, dtype=dtype)
+    rows = np.frombuffer(body, dtype=row_dtype)
+    if rows.size:
+        ok = (rows['_nfields'] == len(columns)).all() and all(
+            (rows[f'_len_{name}'] == np.dtype(code).itemsize).all()
+            for name, code in columns.items())
+        if not ok:
+            return read_sql_copy(sql, conn, dtype=dtype)
+    return pd.DataFrame({name: rows[name].astype(code) for name, code in columns.items()})
+
+
+def read_sql_connectorx(sql, conn=None, dtype=None):
+    """Materialize a query through ConnectorX when it is installed.
+
+    ConnectorX reads the Postgres wire protocol in Rust straight into Arrow
+    and hands pandas the columns without per-row Python objects. The
+    consolidated query's ORDER BY rules out partitioned reads, so this is a
+    single-stream fetch; conn is accepted (and ignored) so the signature
+    matches the other readers.
+    """
+    df = _connectorx.read_sql(conn_str(), sql, return_type='pandas')
+    return df.astype(dtype) if dtype else df
+
+
+def read_sql_stream(sql, conn, dtype=None, itersize=10_000):
+    """Stream a large result through a server-side cursor into Arrow.
+
+    A client-side cursor (and the COPY path) buffers the entire result before
+    pandas sees any of it. A named cursor pulls itersize rows per round trip,
+    bounding peak memory and overlapping network wait with decode; batches go
+    through pyarrow so the final to_pandas is one columnar conversion.
+
+    The default fetch path is read_sql_copy_binary; pass this as the reader
+    instead when a result set is too large to buffer whole.
+    """
+    import pyarrow as pa
+
+    with conn.cursor(name='metrics_stream') as cur:
+        cur.itersize = itersize
+        cur.execute(sql)
+        columns = [d.name for d in cur.description]
+        batches = []
+        while True:
+            rows = cur.fetchmany(itersize)
+            if not rows:
+                break
+            batches.append(pa.record_batch(
+                [pa.array(col) for col in zip(*rows)], names=columns))
+    if not batches:
+        return pd.DataFrame(columns=columns)
+    df = pa.Table.from_batches(batches).to_pandas()
+    return df.astype(dtype) if dtype else df
+
+
+def fetch_cached(sql, conn, fingerprint, dtype=None, reader=None, sort_keys=None):
+    """Fetch with a parquet memo keyed by (database, query hash, fingerprint).
+
+    Event history is append-only, so a memo written under an older
+    fingerprint is still a correct prefix: when one exists, only the rows
+    past its highest block are fetched and appended, instead of re-reading
+    the full history. For that, sql must carry a {delta} hole in each WHERE
+    clause (filled with the block predicate, or removed on a cold fetch) and
+    sort_keys restores the query's global ordering after the append. Assumes
+    blocks are ingested whole, as the sync pipeline does.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # The key carries the connection identity: switching databases (e.g.
+    # beeport2 -> beeport2_testing) must be a cold fetch, never a delta
+    # top-up of another database's memo
+    kw = conn_kwargs()
+    ident = f"{kw['host']}:{kw['port']}/{kw['dbname']}"
+    key = hashlib.sha1(f"{ident}\n{sql}".encode()).hexdigest()[:16]
+    path = os.path.join(CACHE_DIR, f"{key}_{fingerprint}.parquet")
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    run = reader or read_sql_copy
+    stale = glob.glob(os.path.join(CACHE_DIR, f"{key}_*.parquet"))
+    cached = pd.read_parquet(stale[0]) if stale and '{delta}' in sql else None
+    if cached is not None and not cached.empty:
+        cached_max = int(cached['block_number'].max())
+        delta = run(sql.format(delta=f"AND block_number > {cached_max}"),
+                    conn, dtype=dtype)
+        df = pd.concat([cached, delta], ignore_index=True)
+        if sort_keys:
+            df = df.sort_values(sort_keys, ignore_index=True)
+    else:
+        # An empty memo (first run against an empty database) has no block
+        # to delta from; refetch in full rather than crash on its max()
+        df = run(sql.format(delta='') if '{delta}' in sql else sql,
+                 conn, dtype=dtype)
+    for old in stale:
+        os.remove(old)
+    df.to_parquet(path)
+    return df
+
+
+def frozen_counts_per_winner(winners, frozens):
+    """Count StakeFrozen events between consecutive WinnerSelected events.
+
+    Each frozen event belongs to the first winner at or after it in
+    (block_number, log_index) order; frozen events after the last winner are
+    dropped, matching the old correlated-subquery semantics.
+
+    searchsorted + bincount already run this as compiled O((W+F) log W) code,
+    so there is no win left for a numba kernel. The composite key packs the
+    log index into the low 32 bits, which is exact for any realistic log_index.
+    """
+    w_key = (winners['block_number'].to_numpy(np.uint64) << np.uint64(32)) | winners['log_index'].to_numpy(np.uint64)
+    f_key = (frozens['block_number'].to_numpy(np.uint64) << np.uint64(32)) | frozens['log_index'].to_numpy(np.uint64)
+    idx = np.searchsorted(w_key, f_key, side='left')
+    counts = np.bincount(idx[idx < w_key.size], minlength=w_key.size)
+    return pd.DataFrame(
+        {'block_number': winners['block_number'].to_numpy(), 'frozen_stake_count': counts}
+    ).set_index('block_number')
+
+
+def table_fingerprint():
+    """Cheap (max block, row count) fingerprint of both source tables."""
+    conn = get_conn()
+    with conn.cursor() as cur:
+        cur.execute(SIE_COVERING_INDEX_SQL)
+        cur.execute(TABLE_FINGERPRINT_SQL.format(table='storage_incentives_events'))
+        sie_max, sie_count = cur.fetchone()
+        cur.execute(TABLE_FINGERPRINT_SQL.format(table='events'))
+        ev_max, ev_count = cur.fetchone()
+    conn.commit()
+    return f"{sie_max}_{sie_count}_{ev_max}_{ev_count}"
+
+
+def fetch_all(fingerprint=None):
+    """Fetch, split and derive every metric frame, keyed by plot label.
+
+    Callers that already fingerprinted the tables (e.g. for a change gate)
+    pass it in to save the extra round trip.
+    """
+    fingerprint = fingerprint or table_fingerprint()
+
+    # EXTRACT: everything the dashboard needs arrives in one round trip over
+    # the binary COPY path, on the same connection the fingerprint used. The
+    # earlier connection pool + thread fan-out existed to overlap several
+    # queries; with a single query there is nothing left to overlap.
+    conn = get_conn()
+    if _connectorx is not None:
+        reader = read_sql_connectorx
+    else:
+        reader = functools.partial(read_sql_copy_binary, columns=METRICS_COLUMNS)
+    events_df = fetch_cached(METRICS_SQL, conn, fingerprint, reader=reader,
+                             sort_keys=METRICS_SORT_KEYS)
+
+    # TRANSFORM: split the long-format result into per-metric frames. The
+    # query orders by (series, block_number, log_index), so each slice is
+    # already sorted for plotting.
+    by_series = dict(tuple(events_df.groupby('series'))) if not events_df.empty else {}
+    empty = events_df.iloc[0:0]
+    winners = by_series.get(SERIES_WINNER, empty)
+    frozens = by_series.get(SERIES_FROZEN, empty)
+
+    dataframes = {}
+    winner_blocks = winners['block_number']
+    for label, series in ROUND_METRICS:
+        sub = by_series.get(series, empty)
+        sub = sub[sub['block_number'].isin(winner_blocks)]
+        if not sub.empty:
+            dataframes[label] = sub[['block_number', 'value']].set_index('block_number')
+
+    prices = by_series.get(SERIES_PRICE, empty)
+    if not prices.empty:
+        dataframes["Price"] = prices.set_index('block_number')[['value']]
+
+    pots = by_series.get(SERIES_POT, empty)
+    if not pots.empty:
+        dataframes["Pot Withdrawn (log)"] = pots.set_index('block_number')[['value']]
+
+    # Freeze Time and Frozen Events Count both come out of the single
+    # StakeFrozen slice
+    if not frozens.empty:
+        dataframes["Freeze Time"] = frozens.set_index('block_number')[['value']]
+    if not winners.empty:
+        dataframes["Frozen Events Count"] = frozen_counts_per_winner(winners, frozens)
+
+    # LOAD: derive metrics. Reward per Node joins the pot amounts with the
+    # CountCommits rows client-side — no dedicated JOIN query.
+    if not pots.empty:
+        raw_df = pots.set_index('block_number')[['value']].rename(columns={'value': 'pot_amount'})
+        commits = by_series.get(SERIES_COMMITS, empty)
+        commit_map = commits.set_index('block_number')['value']
+        raw_df['commit_count'] = raw_df.index.map(commit_map).fillna(0)
+
+        # 10-round moving average: sum(pot_withdrawn) / sum(commits)
+        window = 10
+        raw_df['pot_sum'] = raw_df['pot_amount'].rolling(window=window, min_periods=1).sum()
+        raw_df['commit_sum'] = raw_df['commit_count'].rolling(window=window, min_periods=1).sum()
+        raw_df['reward_per_node'] = raw_df['pot_sum'] / raw_df['commit_sum'].replace(0, np.nan)
+
+        reward = raw_df[['reward_per_node']].dropna()
+        if not reward.empty:
+            dataframes['Reward per Node'] = reward
+
+    return dataframes